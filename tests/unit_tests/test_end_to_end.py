@@ -1,18 +1,25 @@
+import asyncio
+import functools
 import inspect
+import itertools
 import math
+import os
 import types
-import uuid
-from typing import Callable
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, ContextManager, Iterator
 from unittest.mock import patch
 
+import numpy as np
 import pytest
 from langchain_core.embeddings import Embeddings
 from langchain_core.embeddings.fake import DeterministicFakeEmbedding
 from langchain_core.language_models import GenericFakeChatModel, LanguageModelLike
 from langchain_core.messages import AIMessage, ToolMessage
 from langchain_core.tools import BaseTool
+from langgraph.graph.state import CompiledStateGraph
 from langgraph.prebuilt import InjectedStore
-from langgraph.store.base import BaseStore
+from langgraph.store.base import BaseStore, IndexConfig, PutOp, SearchItem
 from langgraph.store.memory import InMemoryStore
 from typing_extensions import Annotated
 
@@ -23,23 +30,50 @@ from langgraph_bigtool.utils import convert_positional_only_function_to_tool
 EMBEDDING_SIZE = 1536
 
 
-# Create a list of all the functions in the math module
-all_names = dir(math)
+@functools.cache
+def _all_tools() -> list[BaseTool]:
+    # Create a list of all the functions in the math module
+    all_names = dir(math)
 
-math_functions = [
-    getattr(math, name)
-    for name in all_names
-    if isinstance(getattr(math, name), types.BuiltinFunctionType)
-]
+    math_functions = [
+        function
+        for function in (getattr(math, name) for name in all_names)
+        if isinstance(function, types.BuiltinFunctionType)
+    ]
+
+    # Convert to tools, handling positional-only arguments (idiosyncrasy of math module)
+    all_tools = []
+    for function in math_functions:
+        if wrapper := convert_positional_only_function_to_tool(function):
+            all_tools.append(wrapper)
+    return all_tools
+
+
+def _random_ids(n: int) -> list[str]:
+    """Generate ``n`` random hex IDs from a single ``os.urandom`` call."""
+    raw = os.urandom(16 * n)
+    return [raw[i : i + 16].hex() for i in range(0, 16 * n, 16)]
+
+
+@functools.cache
+def _tool_registry() -> dict[str, BaseTool]:
+    # Store tool objects in registry
+    all_tools = _all_tools()
+    return dict(zip(_random_ids(len(all_tools)), all_tools, strict=True))
 
-# Convert to tools, handling positional-only arguments (idiosyncrasy of math module)
-all_tools = []
-for function in math_functions:
-    if wrapper := convert_positional_only_function_to_tool(function):
-        all_tools.append(wrapper)
 
-# Store tool objects in registry
-tool_registry = {str(uuid.uuid4()): tool for tool in all_tools}
+@functools.cache
+def _tool_id_by_name() -> dict[str, str]:
+    return {tool.name: tool_id for tool_id, tool in _tool_registry().items()}
+
+
+@functools.cache
+def _tool_texts() -> dict[str, str]:
+    """Text indexed for each tool; retrieval queries reuse it to match exactly."""
+    return {
+        tool_id: f"{tool.name}: {tool.description}"
+        for tool_id, tool in _tool_registry().items()
+    }
 
 
 class FakeModel(GenericFakeChatModel):
@@ -48,160 +82,434 @@ class FakeModel(GenericFakeChatModel):
         return self
 
 
-def _get_fake_llm_and_embeddings(retriever_tool_name: str = "retrieve_tools"):
-    fake_embeddings = DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
-
-    acos_tool = next(tool for tool in tool_registry.values() if tool.name == "acos")
-    initial_query = (
-        f"{acos_tool.name}: {acos_tool.description}"  # make same as embedding
-    )
-    fake_llm = FakeModel(
-        messages=iter(
+def _inverse_norms(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1)
+    return np.divide(1.0, norms, out=np.zeros_like(norms), where=norms != 0)
+
+
+def _topk_cosine(
+    matrix: np.ndarray,
+    inverse_norms: np.ndarray,
+    query: np.ndarray,
+    eligible: np.ndarray,
+    k: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the indices and cosine scores of the best ``k`` eligible rows.
+
+    Plain NumPy in separate passes: a float32 matrix-vector product, scaling by
+    inverse norms, then a partial sort.
+    """
+    scores = (matrix @ query) * (inverse_norms * _inverse_norms(query))
+    scores[~eligible] = -np.inf
+    k = min(k, int(eligible.sum()))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return top, scores[top]
+
+
+class FastInMemoryStore(InMemoryStore):
+    """InMemoryStore that ranks vectors with a single matrix-vector product.
+
+    Embeddings are staged into one contiguous float32 matrix, with their inverse
+    norms, as they are inserted; each indexed path of an item gets its own row.
+    Unfiltered semantic searches are then answered with ``V @ q`` and a partial
+    sort instead of per-item cosine comparisons, and their results are cached by
+    query until the next write. Other searches fall back to the parent.
+    """
+
+    search_cache_size = 128
+
+    def __init__(self, *, index: IndexConfig | None = None) -> None:
+        super().__init__(index=index)
+        dims = index["dims"] if index else 0
+        self._row_keys: list[tuple[tuple[str, ...], str, str]] = []
+        self._row_index: dict[tuple[tuple[str, ...], str, str], int] = {}
+        self._item_rows: dict[tuple[tuple[str, ...], str], list[int]] = {}
+        # Set once any item is indexed on more than one path
+        self._multi_row_items = False
+        # Rows record their namespace as a small id, so prefix matching per query
+        # touches each namespace once rather than each row
+        self._namespace_ids: dict[tuple[str, ...], int] = {}
+        self._row_namespaces = np.empty(0, dtype=np.intp)
+        # False for rows whose item was deleted; they stay in the matrix unranked
+        self._live = np.empty(0, dtype=bool)
+        self._matrix = np.empty((0, dims), dtype=np.float32)
+        self._inverse_norms = np.empty(0, dtype=np.float32)
+        self._search_cache: OrderedDict[tuple, list[SearchItem]] = OrderedDict()
+
+    def _insertinmem_store(
+        self,
+        to_embed: dict[str, list[tuple[tuple[str, ...], str, str]]],
+        embeddings: list[list[float]],
+    ) -> None:
+        super()._insertinmem_store(to_embed, embeddings)
+        rows = np.asarray(embeddings, dtype=np.float32)
+        updates = []
+        new_namespaces = []
+        for row, row_key in zip(
+            rows,
+            (index for indices in to_embed.values() for index in indices),
+            strict=True,
+        ):
+            if row_key not in self._row_index:
+                self._row_index[row_key] = len(self._row_keys)
+                item_rows = self._item_rows.setdefault(row_key[:2], [])
+                item_rows.append(len(self._row_keys))
+                self._multi_row_items |= len(item_rows) > 1
+                new_namespaces.append(
+                    self._namespace_ids.setdefault(row_key[0], len(self._namespace_ids))
+                )
+                self._row_keys.append(row_key)
+            updates.append((self._row_index[row_key], row))
+        # Grow the matrix before writing, so new rows are never indexed past its end
+        if (missing := len(self._row_keys) - len(self._matrix)) > 0:
+            self._matrix = np.vstack(
+                [self._matrix, np.zeros((missing, self._matrix.shape[1]), np.float32)]
+            )
+            self._live = np.append(self._live, np.zeros(missing, dtype=bool))
+            self._row_namespaces = np.append(self._row_namespaces, new_namespaces)
+        for row_index, row in updates:
+            self._matrix[row_index] = row
+            self._live[row_index] = True
+        self._inverse_norms = _inverse_norms(self._matrix)
+
+    def _apply_put_ops(self, put_ops: dict[tuple[tuple[str, ...], str], PutOp]) -> None:
+        super()._apply_put_ops(put_ops)
+        # The parent drops a deleted item's vectors; mask its rows to match
+        for item, op in put_ops.items():
+            if op.value is None:
+                self._live[self._item_rows.get(item, [])] = False
+        # Any write may change rankings, so cached searches are dropped
+        self._search_cache.clear()
+
+    def _get_cached_search(self, key: tuple) -> list[SearchItem] | None:
+        if (results := self._search_cache.get(key)) is not None:
+            self._search_cache.move_to_end(key)
+        return results
+
+    def _cache_search(self, key: tuple, results: list[SearchItem]) -> list[SearchItem]:
+        self._search_cache[key] = results
+        if len(self._search_cache) > self.search_cache_size:
+            self._search_cache.popitem(last=False)
+        return results
+
+    def _top_k(
+        self,
+        namespace_prefix: tuple[str, ...],
+        query_vector: list[float],
+        limit: int,
+        offset: int,
+    ) -> list[SearchItem]:
+        # Skip rows outside the namespace or whose item has since been deleted
+        eligible = self._live & np.isin(
+            self._row_namespaces,
             [
-                AIMessage(
-                    "",
-                    tool_calls=[
-                        {
-                            "name": retriever_tool_name,
-                            "args": {"query": initial_query},
-                            "id": "abc123",
-                            "type": "tool_call",
-                        }
-                    ],
-                ),
-                AIMessage(
-                    "",
-                    tool_calls=[
-                        {
-                            "name": "acos",
-                            "args": {"x": 0.5},
-                            "id": "abc234",
-                            "type": "tool_call",
-                        }
-                    ],
-                ),
-                AIMessage("The arc cosine of 0.5 is approximately 1.047 radians."),
-            ]
+                namespace_id
+                for ns, namespace_id in self._namespace_ids.items()
+                if ns[: len(namespace_prefix)] == namespace_prefix
+            ],
         )
+        top, scores = _topk_cosine(
+            self._matrix,
+            self._inverse_norms,
+            np.asarray(query_vector, dtype=np.float32),
+            eligible,
+            # Items indexed on several paths have several rows. In that case rank
+            # every row so max pooling below can still fill the requested page.
+            len(self._row_keys) if self._multi_row_items else offset + limit,
+        )
+        # Max pooling: rows are sorted by score, so an item's first row is its best
+        seen: set[tuple[tuple[str, ...], str]] = set()
+        results = []
+        for row, score in zip(top, scores, strict=True):
+            ns, key, _ = self._row_keys[row]
+            if (ns, key) in seen:
+                continue
+            seen.add((ns, key))
+            if len(seen) <= offset:
+                continue
+            item = self._data[ns][key]
+            results.append(
+                SearchItem(
+                    namespace=item.namespace,
+                    key=item.key,
+                    value=item.value,
+                    created_at=item.created_at,
+                    updated_at=item.updated_at,
+                    score=float(score),
+                )
+            )
+            if len(results) == limit:
+                break
+        if len(results) < limit:
+            # Like the parent, fill the page with items that have no embedding
+            scoreless = (
+                item
+                for ns, items in self._data.items()
+                if ns[: len(namespace_prefix)] == namespace_prefix
+                for key, item in items.items()
+                if not self._vectors.get(ns, {}).get(key)
+            )
+            results.extend(
+                SearchItem(
+                    namespace=item.namespace,
+                    key=item.key,
+                    value=item.value,
+                    created_at=item.created_at,
+                    updated_at=item.updated_at,
+                )
+                for item in itertools.islice(scoreless, limit - len(results))
+            )
+        return results
+
+    def search(
+        self,
+        namespace_prefix: tuple[str, ...],
+        /,
+        *,
+        query: str | None = None,
+        filter: dict[str, Any] | None = None,
+        limit: int = 10,
+        offset: int = 0,
+        refresh_ttl: bool | None = None,
+    ) -> list[SearchItem]:
+        if query is None or filter or self.embeddings is None:
+            return super().search(
+                namespace_prefix,
+                query=query,
+                filter=filter,
+                limit=limit,
+                offset=offset,
+                refresh_ttl=refresh_ttl,
+            )
+        key = (namespace_prefix, query, limit, offset)
+        if (results := self._get_cached_search(key)) is None:
+            query_vector = self.embeddings.embed_query(query)
+            results = self._cache_search(
+                key, self._top_k(namespace_prefix, query_vector, limit, offset)
+            )
+        return list(results)
+
+    async def asearch(
+        self,
+        namespace_prefix: tuple[str, ...],
+        /,
+        *,
+        query: str | None = None,
+        filter: dict[str, Any] | None = None,
+        limit: int = 10,
+        offset: int = 0,
+        refresh_ttl: bool | None = None,
+    ) -> list[SearchItem]:
+        if query is None or filter or self.embeddings is None:
+            return await super().asearch(
+                namespace_prefix,
+                query=query,
+                filter=filter,
+                limit=limit,
+                offset=offset,
+                refresh_ttl=refresh_ttl,
+            )
+        key = (namespace_prefix, query, limit, offset)
+        if (results := self._get_cached_search(key)) is None:
+            query_vector = await self.embeddings.aembed_query(query)
+            results = self._cache_search(
+                key, self._top_k(namespace_prefix, query_vector, limit, offset)
+            )
+        return list(results)
+
+
+def _bulk_index(store: BaseStore, descriptions: dict[str, str]) -> None:
+    """Index tool descriptions with a single batch (one embed_documents call)."""
+    store.batch(
+        [
+            PutOp(("tools",), tool_id, {"description": description})
+            for tool_id, description in descriptions.items()
+        ]
     )
 
-    return fake_llm, fake_embeddings
 
+@pytest.fixture(scope="session")
+def fake_embeddings() -> Embeddings:
+    return DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
 
-def _validate_result(result: State, tool_registry=tool_registry) -> None:
-    assert set(result.keys()) == {"messages", "selected_tool_ids"}
-    selected = []
-    for tool_id in result["selected_tool_ids"]:
-        if isinstance(tool_registry[tool_id], BaseTool):
-            selected.append(tool_registry[tool_id].name)
-        else:
-            selected.append(tool_registry[tool_id].__name__)
-    assert "acos" in selected
-    assert set(message.type for message in result["messages"]) == {
-        "human",
-        "ai",
-        "tool",
-    }
-    tool_calls = [
-        tool_call
-        for message in result["messages"]
-        if isinstance(message, AIMessage)
-        for tool_call in message.tool_calls
+
+def build_tool_store(
+    embeddings: Embeddings, store_cls: type[InMemoryStore] = InMemoryStore
+) -> BaseStore:
+    """Build a store with every registry tool's description indexed."""
+    store = store_cls(
+        index={
+            "embed": embeddings,
+            "dims": EMBEDDING_SIZE,
+            "fields": ["description"],
+        }
+    )
+    _bulk_index(store, _tool_texts())
+    return store
+
+
+@pytest.fixture(scope="session")
+def store(fake_embeddings: Embeddings) -> BaseStore:
+    # Index tool descriptions once per session with the sync API. Sync and async
+    # tests only read from the store, so the async tests need no aput calls.
+    return build_tool_store(fake_embeddings, FastInMemoryStore)
+
+
+def _fake_llm_messages(retriever_tool_name: str, initial_query: str) -> list[AIMessage]:
+    # Fresh messages per run: LangChain stamps ``id`` on returned messages in
+    # place, so message objects must not be shared between runs.
+    return [
+        AIMessage(
+            "",
+            tool_calls=[
+                {
+                    "name": retriever_tool_name,
+                    "args": {"query": initial_query},
+                    "id": "abc123",
+                    "type": "tool_call",
+                }
+            ],
+        ),
+        AIMessage(
+            "",
+            tool_calls=[
+                {
+                    "name": "acos",
+                    "args": {"x": 0.5},
+                    "id": "abc234",
+                    "type": "tool_call",
+                }
+            ],
+        ),
+        AIMessage("The arc cosine of 0.5 is approximately 1.047 radians."),
     ]
-    assert tool_calls
-    tool_call_names = [tool_call["name"] for tool_call in tool_calls]
+
+
+def _get_fake_llm(
+    retriever_tool_name: str = "retrieve_tools", initial_query: str | None = None
+) -> FakeModel:
+    if initial_query is None:
+        initial_query = _tool_texts()[_tool_id_by_name()["acos"]]
+    return FakeModel(
+        messages=iter(_fake_llm_messages(retriever_tool_name, initial_query))
+    )
+
+
+def _tool_name(tool: BaseTool | Callable) -> str:
+    return tool.name if isinstance(tool, BaseTool) else tool.__name__
+
+
+def _validate_result(
+    result: State, tool_registry: dict[str, BaseTool | Callable] | None = None
+) -> None:
+    if tool_registry is None:
+        tool_registry = _tool_registry()
+    assert set(result.keys()) == {"messages", "selected_tool_ids"}
+    assert any(
+        _tool_name(tool_registry[tool_id]) == "acos"
+        for tool_id in result["selected_tool_ids"]
+    )
+    # Collect everything needed from the message history in one pass
+    message_types: set[str] = set()
+    tool_call_names: set[str] = set()
+    math_tool_calls = []
+    tool_messages_by_id: dict[str, list[ToolMessage]] = {}
+    for message in result["messages"]:
+        message_types.add(message.type)
+        if isinstance(message, AIMessage):
+            for tool_call in message.tool_calls:
+                tool_call_names.add(tool_call["name"])
+                if tool_call["name"] == "acos":
+                    math_tool_calls.append(tool_call)
+        elif isinstance(message, ToolMessage):
+            tool_messages_by_id.setdefault(message.tool_call_id, []).append(message)
+    assert message_types == {"human", "ai", "tool"}
+    assert tool_call_names
     assert "retrieve_tools" in tool_call_names
-    math_tool_calls = [
-        tool_call for tool_call in tool_calls if tool_call["name"] == "acos"
-    ]
     assert len(math_tool_calls) == 1
-    math_tool_call = math_tool_calls[0]
-    tool_messages = [
-        message
-        for message in result["messages"]
-        if isinstance(message, ToolMessage)
-        and message.tool_call_id == math_tool_call["id"]
-    ]
+    tool_messages = tool_messages_by_id.get(math_tool_calls[0]["id"], [])
     assert len(tool_messages) == 1
-    tool_message = tool_messages[0]
-    assert round(float(tool_message.content), 4) == 1.0472
+    assert round(float(tool_messages[0].content), 4) == 1.0472
     reply = result["messages"][-1]
     assert isinstance(reply, AIMessage)
     assert not reply.tool_calls
     assert reply.content
 
 
-def run_end_to_end_test(
-    llm: LanguageModelLike,
-    embeddings: Embeddings,
-    retrieve_tools_function: Callable | None = None,
-    retrieve_tools_coroutine: Callable | None = None,
-) -> None:
-    # Store tool descriptions in store
-    store = InMemoryStore(
-        index={
-            "embed": embeddings,
-            "dims": EMBEDDING_SIZE,
-            "fields": ["description"],
-        }
-    )
-    for tool_id, tool in tool_registry.items():
-        store.put(
-            ("tools",),
-            tool_id,
-            {
-                "description": f"{tool.name}: {tool.description}",
-            },
-        )
+class _SwappableLLM:
+    """Forward to a replaceable model so a compiled agent can serve many tests."""
+
+    def __init__(self) -> None:
+        self.llm: LanguageModelLike | None = None
+
+    @contextmanager
+    def use(self, llm: LanguageModelLike) -> Iterator[None]:
+        """Route the agent to ``llm`` for one run, refusing overlapping runs."""
+        if self.llm is not None:
+            raise RuntimeError("Cached agent is already running with another model")
+        self.llm = llm
+        try:
+            yield
+        finally:
+            self.llm = None
+
+    def bind_tools(self, *args, **kwargs) -> LanguageModelLike:
+        return self.llm.bind_tools(*args, **kwargs)
+
+
+@functools.lru_cache(maxsize=8)
+def _make_agent(
+    store: BaseStore,
+    retrieve_tools_function: Callable | None,
+    retrieve_tools_coroutine: Callable | None,
+) -> tuple[CompiledStateGraph, _SwappableLLM]:
+    """Compile the agent once per store and retriever configuration.
 
+    Callers wrap each run in ``llm_slot.use(llm)``, which raises if a run sharing
+    the configuration is still in progress.
+    """
+    llm_slot = _SwappableLLM()
     builder = create_agent(
-        llm,
-        tool_registry,
+        llm_slot,
+        _tool_registry(),
         retrieve_tools_function=retrieve_tools_function,
         retrieve_tools_coroutine=retrieve_tools_coroutine,
     )
-    agent = builder.compile(store=store)
+    return builder.compile(store=store), llm_slot
 
-    result = agent.invoke(
-        {"messages": "Use available tools to calculate arc cosine of 0.5."}
+
+def run_end_to_end_test(
+    llm: LanguageModelLike,
+    store: BaseStore,
+    retrieve_tools_function: Callable | None = None,
+    retrieve_tools_coroutine: Callable | None = None,
+) -> None:
+    agent, llm_slot = _make_agent(
+        store, retrieve_tools_function, retrieve_tools_coroutine
     )
+    with llm_slot.use(llm):
+        result = agent.invoke(
+            {"messages": "Use available tools to calculate arc cosine of 0.5."}
+        )
     _validate_result(result)
 
 
 async def run_end_to_end_test_async(
     llm: LanguageModelLike,
-    embeddings: Embeddings,
+    store: BaseStore,
     retrieve_tools_function: Callable | None = None,
     retrieve_tools_coroutine: Callable | None = None,
 ) -> None:
-    # Store tool descriptions in store
-    store = InMemoryStore(
-        index={
-            "embed": embeddings,
-            "dims": EMBEDDING_SIZE,
-            "fields": ["description"],
-        }
+    agent, llm_slot = _make_agent(
+        store, retrieve_tools_function, retrieve_tools_coroutine
     )
-    for tool_id, tool in tool_registry.items():
-        await store.aput(
-            ("tools",),
-            tool_id,
-            {
-                "description": f"{tool.name}: {tool.description}",
-            },
+    with llm_slot.use(llm):
+        result = await agent.ainvoke(
+            {"messages": "Use available tools to calculate arc cosine of 0.5."}
         )
-
-    builder = create_agent(
-        llm,
-        tool_registry,
-        retrieve_tools_function=retrieve_tools_function,
-        retrieve_tools_coroutine=retrieve_tools_coroutine,
-    )
-    agent = builder.compile(store=store)
-
-    result = await agent.ainvoke(
-        {"messages": "Use available tools to calculate arc cosine of 0.5."}
-    )
     _validate_result(result)
 
 
@@ -237,113 +545,109 @@ async def acustom_retrieve_tools_no_store(query: str) -> list[str]:
     raise CustomError
 
 
-@pytest.mark.parametrize(
+def _get_custom_retriever_kwargs(
+    custom_retrieve_tools: Callable,
+    acustom_retrieve_tools: Callable,
+    use_function: bool,
+    use_coroutine: bool,
+) -> tuple[str, dict[str, Callable | None]]:
+    """Select the custom retrievers for a scenario and the tool name they expose."""
+    kwargs = {
+        "retrieve_tools_function": custom_retrieve_tools if use_function else None,
+        "retrieve_tools_coroutine": acustom_retrieve_tools if use_coroutine else None,
+    }
+    if use_function:
+        retriever_tool_name = custom_retrieve_tools.__name__
+    elif use_coroutine:
+        retriever_tool_name = acustom_retrieve_tools.__name__
+    else:
+        retriever_tool_name = "retrieve_tools"
+    return retriever_tool_name, kwargs
+
+
+def _expect(exception: type[Exception] | None) -> ContextManager:
+    return pytest.raises(exception) if exception else nullcontext()
+
+
+custom_retrievers = pytest.mark.parametrize(
     "custom_retrieve_tools, acustom_retrieve_tools",
     [
         (custom_retrieve_tools_store, acustom_retrieve_tools_store),
         (custom_retrieve_tools_no_store, acustom_retrieve_tools_no_store),
     ],
 )
-def test_end_to_end(custom_retrieve_tools, acustom_retrieve_tools) -> None:
-    retriever_tool_name = custom_retrieve_tools.__name__
-    retriever_tool_name_async = acustom_retrieve_tools.__name__
-    # Default
-    fake_llm, fake_embeddings = _get_fake_llm_and_embeddings()
-    run_end_to_end_test(fake_llm, fake_embeddings)
-
-    # Custom
-    fake_llm, fake_embeddings = _get_fake_llm_and_embeddings(
-        retriever_tool_name=retriever_tool_name_async
-    )
-    with pytest.raises(TypeError):
-        # No sync function provided
-        run_end_to_end_test(
-            fake_llm,
-            fake_embeddings,
-            retrieve_tools_coroutine=acustom_retrieve_tools,
-        )
-
-    fake_llm, fake_embeddings = _get_fake_llm_and_embeddings(
-        retriever_tool_name=retriever_tool_name
-    )
-    with pytest.raises(CustomError):
-        # Calls custom sync function
-        run_end_to_end_test(
-            fake_llm,
-            fake_embeddings,
-            retrieve_tools_function=custom_retrieve_tools,
-            retrieve_tools_coroutine=acustom_retrieve_tools,
-        )
-
-    fake_llm, fake_embeddings = _get_fake_llm_and_embeddings(
-        retriever_tool_name=retriever_tool_name
-    )
-    with pytest.raises(CustomError):
-        # Calls custom sync function
-        run_end_to_end_test(
-            fake_llm,
-            fake_embeddings,
-            retrieve_tools_function=custom_retrieve_tools,
-        )
 
 
+@custom_retrievers
 @pytest.mark.parametrize(
-    "custom_retrieve_tools, acustom_retrieve_tools",
+    "use_function, use_coroutine, expected_exception",
     [
-        (custom_retrieve_tools_store, acustom_retrieve_tools_store),
-        (custom_retrieve_tools_no_store, acustom_retrieve_tools_no_store),
+        pytest.param(False, False, None, id="default"),
+        # No sync function provided
+        pytest.param(False, True, TypeError, id="coroutine"),
+        # Calls custom sync function
+        pytest.param(True, True, CustomError, id="function-and-coroutine"),
+        pytest.param(True, False, CustomError, id="function"),
     ],
 )
-async def test_end_to_end_async(custom_retrieve_tools, acustom_retrieve_tools) -> None:
-    retriever_tool_name = custom_retrieve_tools.__name__
-    retriever_tool_name_async = acustom_retrieve_tools.__name__
-    # Default
-    fake_llm, fake_embeddings = _get_fake_llm_and_embeddings()
-    await run_end_to_end_test_async(fake_llm, fake_embeddings)
-
-    # Custom
-    fake_llm, fake_embeddings = _get_fake_llm_and_embeddings(
-        retriever_tool_name=retriever_tool_name
+def test_end_to_end(
+    custom_retrieve_tools,
+    acustom_retrieve_tools,
+    use_function: bool,
+    use_coroutine: bool,
+    expected_exception: type[Exception] | None,
+    store: BaseStore,
+) -> None:
+    retriever_tool_name, kwargs = _get_custom_retriever_kwargs(
+        custom_retrieve_tools, acustom_retrieve_tools, use_function, use_coroutine
     )
-    with pytest.raises(CustomError):
-        # Calls custom sync function
-        await run_end_to_end_test_async(
-            fake_llm,
-            fake_embeddings,
-            retrieve_tools_function=custom_retrieve_tools,
-        )
+    fake_llm = _get_fake_llm(retriever_tool_name=retriever_tool_name)
+    with _expect(expected_exception):
+        run_end_to_end_test(fake_llm, store, **kwargs)
 
-    fake_llm, fake_embeddings = _get_fake_llm_and_embeddings(
-        retriever_tool_name=retriever_tool_name
-    )
-    with pytest.raises(CustomError):
-        # Calls custom sync function
-        await run_end_to_end_test_async(
-            fake_llm,
-            fake_embeddings,
-            retrieve_tools_function=custom_retrieve_tools,
-            retrieve_tools_coroutine=acustom_retrieve_tools,
-        )
 
-    fake_llm, fake_embeddings = _get_fake_llm_and_embeddings(
-        retriever_tool_name=retriever_tool_name_async
-    )
-    with pytest.raises(CustomError):
+@custom_retrievers
+async def test_end_to_end_async(
+    custom_retrieve_tools, acustom_retrieve_tools, store: BaseStore
+) -> None:
+    # (use_function, use_coroutine, expected_exception)
+    scenarios = [
+        # Default
+        (False, False, None),
         # Calls custom sync function
-        await run_end_to_end_test_async(
-            fake_llm,
-            fake_embeddings,
-            retrieve_tools_coroutine=acustom_retrieve_tools,
+        (True, False, CustomError),
+        (True, True, CustomError),
+        (False, True, CustomError),
+    ]
+    # Scenarios use distinct retriever configurations, so they never share a
+    # cached agent (its LLM slot would raise), and each gets its own FakeModel.
+    runs = []
+    for use_function, use_coroutine, _ in scenarios:
+        retriever_tool_name, kwargs = _get_custom_retriever_kwargs(
+            custom_retrieve_tools, acustom_retrieve_tools, use_function, use_coroutine
         )
-
-
-def test_duplicate_tools() -> None:
-    fake_embeddings = DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
-
-    acos_tool = next(tool for tool in tool_registry.values() if tool.name == "acos")
-    initial_query = (
-        f"{acos_tool.name}: {acos_tool.description}"  # make same as embedding
-    )
+        fake_llm = _get_fake_llm(retriever_tool_name=retriever_tool_name)
+        runs.append(run_end_to_end_test_async(fake_llm, store, **kwargs))
+    results = await asyncio.gather(*runs, return_exceptions=True)
+
+    # Check every scenario, so one failure does not hide the others
+    failures = []
+    for (use_function, use_coroutine, expected_exception), result in zip(
+        scenarios, results, strict=True
+    ):
+        scenario = f"use_function={use_function}, use_coroutine={use_coroutine}"
+        if expected_exception is None:
+            if isinstance(result, BaseException):
+                failures.append(f"{scenario}: raised {result!r}")
+        elif not isinstance(result, expected_exception):
+            failures.append(
+                f"{scenario}: expected {expected_exception.__name__}, got {result!r}"
+            )
+    assert not failures, "\n".join(failures)
+
+
+def test_duplicate_tools(store: BaseStore) -> None:
+    initial_query = _tool_texts()[_tool_id_by_name()["acos"]]
 
     fake_llm = FakeModel(
         messages=iter(
@@ -396,65 +700,39 @@ def test_duplicate_tools() -> None:
     with patch.object(
         FakeModel, "bind_tools", wraps=fake_llm.bind_tools
     ) as mock_bind_tools:
-        run_end_to_end_test(fake_llm, fake_embeddings)
+        run_end_to_end_test(fake_llm, store)
         mock_bind_tools.assert_called()
         for args, _ in mock_bind_tools.call_args_list:
             tool_names = [tool.name for tool in args[0] if isinstance(tool, BaseTool)]
             assert len(tool_names) == len(set(tool_names))
 
 
-def test_functions_in_registry() -> None:
-    tool_registry = {str(uuid.uuid4()): tool.func for tool in all_tools}
-    fake_embeddings = DeterministicFakeEmbedding(size=EMBEDDING_SIZE)
-
-    acos_tool = next(tool for tool in tool_registry.values() if tool.__name__ == "acos")
-    initial_query = (
-        f"{acos_tool.__name__}: {inspect.getdoc(acos_tool)}"  # make same as embedding
-    )
-    fake_llm = FakeModel(
-        messages=iter(
-            [
-                AIMessage(
-                    "",
-                    tool_calls=[
-                        {
-                            "name": "retrieve_tools",
-                            "args": {"query": initial_query},
-                            "id": "abc123",
-                            "type": "tool_call",
-                        }
-                    ],
-                ),
-                AIMessage(
-                    "",
-                    tool_calls=[
-                        {
-                            "name": "acos",
-                            "args": {"x": 0.5},
-                            "id": "abc234",
-                            "type": "tool_call",
-                        }
-                    ],
-                ),
-                AIMessage("The arc cosine of 0.5 is approximately 1.047 radians."),
-            ]
+def test_functions_in_registry(fake_embeddings: Embeddings) -> None:
+    all_tools = _all_tools()
+    tool_registry = dict(
+        zip(
+            _random_ids(len(all_tools)),
+            (tool.func for tool in all_tools),
+            strict=True,
         )
     )
-    store = InMemoryStore(
+
+    tool_texts = {
+        tool_id: f"{tool.__name__}: {inspect.getdoc(tool)}"
+        for tool_id, tool in tool_registry.items()
+    }
+    acos_id = next(
+        tool_id for tool_id, tool in tool_registry.items() if tool.__name__ == "acos"
+    )
+    fake_llm = _get_fake_llm(initial_query=tool_texts[acos_id])
+    store = FastInMemoryStore(
         index={
             "embed": fake_embeddings,
             "dims": EMBEDDING_SIZE,
             "fields": ["description"],
         }
     )
-    for tool_id, tool in tool_registry.items():
-        store.put(
-            ("tools",),
-            tool_id,
-            {
-                "description": f"{tool.__name__}: {inspect.getdoc(tool)}",
-            },
-        )
+    _bulk_index(store, tool_texts)
 
     builder = create_agent(
         fake_llm,